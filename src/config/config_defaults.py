@@ -380,6 +380,18 @@ class ConfigDefault(Serializable):
     max_num_width_samples: float | None = create(None)
     """Maximum number samples along the time dimension. For spectrogram: width truncation, for audio: waveform truncation. Useful for limiting transformer input size."""
 
+    spectrogram_cache_dir: Path | None = create(None)
+    """Directory where melspectrograms of audios without waveform augmentations are cached (float16 .npy). Each set of spectrogram parameters gets its own subdirectory."""
+
+    recompute_spectrogram_cache: bool = create(False)
+    """Delete the cached melspectrograms for the current spectrogram parameters and compute them again."""
+
+    spectrogram_on_device: bool = create(False)
+    """Calculate melspectrograms of the whole batch on the training device (e.g. GPU) after the batch transfer instead of in DataLoader workers. Only for the mel spectrogram audio transform."""
+
+    batch_audio_transform: bool = create(False)
+    """Create features of the whole batch at once in the collate function (audio_transform.process_batch) instead of for every item in the dataset. Cached spectrograms aren't used."""
+
     augmentations: list[SupportedAugmentations] = create(_default_augmentations_list)
     """Transformation which will be performed on audio and labels"""
 
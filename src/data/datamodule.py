@@ -28,7 +28,9 @@ from src.data.dataset_csv import CSVDataset
 from src.data.dataset_inference import InferenceDataset
 from src.data.dataset_irmas import IRMASDatasetTest, IRMASDatasetTrain
 from src.enums.enums import SupportedDatasetDirType
+from src.features.audio_to_spectrogram import GPUMelCollate, MelSpectrogram
 from src.features.audio_transform_base import AudioTransformBase
+from src.features.chunking import CollateFnAudioBatch
 from src.utils.utils_functions import dict_without_keys
 
 
@@ -64,6 +66,8 @@ class OurDataModule(pl.LightningDataModule):
         sampling_rate: int,
         num_classes: int = config_defaults.DEFAULT_NUM_LABELS,
         train_override_csvs: list[Path] | None = None,
+        spectrogram_on_device: bool = False,
+        batch_audio_transform: bool = False,
     ):
         super().__init__()
         self.batch_size = batch_size
@@ -89,6 +93,16 @@ class OurDataModule(pl.LightningDataModule):
         self.val_dataset = None
         self.test_dataset = None
         self.train_override_csvs = train_override_csvs
+        self.spectrogram_on_device = spectrogram_on_device
+        self.batch_audio_transform = batch_audio_transform
+
+        if self.spectrogram_on_device:
+            assert isinstance(train_audio_transform, MelSpectrogram) and isinstance(
+                val_audio_transform, MelSpectrogram
+            ), "Spectrograms can be calculated on the device only for MelSpectrogram."
+            assert (
+                not self.batch_audio_transform
+            ), "Use either spectrogram_on_device or batch_audio_transform."
 
         self._train_stats: dict | None = None
         self._val_stats: dict | None = None
@@ -226,6 +240,10 @@ class OurDataModule(pl.LightningDataModule):
         if dataset_paths is None:
             return None
 
+        # Datasets return audios if the features are created by the collate function
+        if self.collate_transforms_audio:
+            transform = None
+
         datasets: list[Dataset] = []
         for dataset_enum, dataset_path in dataset_paths:
             print(
@@ -296,6 +314,30 @@ class OurDataModule(pl.LightningDataModule):
                 stats[k] += v
         return stats
 
+    @property
+    def collate_transforms_audio(self) -> bool:
+        """Datasets return audios and features are created by the collate function."""
+        return self.spectrogram_on_device or self.batch_audio_transform
+
+    def get_collate_fn(self, audio_transform: AudioTransformBase) -> Callable | None:
+        if self.spectrogram_on_device:
+            return GPUMelCollate(audio_transform)
+        if self.batch_audio_transform:
+            return CollateFnAudioBatch(audio_transform)
+        return self.collate_fn
+
+    def on_after_batch_transfer(self, batch, dataloader_idx: int):
+        """Calculates melspectrograms on the device if spectrogram_on_device is set.
+
+        Lightning calls this hook for train, val, test and predict dataloaders alike, so all of
+        them use GPUMelCollate (see get_collate_fn) when spectrogram_on_device is set.
+        """
+        if not self.spectrogram_on_device:
+            return batch
+        training = self.trainer is not None and self.trainer.training
+        transform = self.train_audio_transform if training else self.val_audio_transform
+        return self.get_collate_fn(transform).on_after_batch_transfer(batch)
+
     def train_dataloader(self) -> DataLoader[ConcatDataset[DatasetGetItem]]:
         assert (
             self.train_dataset is not None
@@ -306,7 +348,7 @@ class OurDataModule(pl.LightningDataModule):
             num_workers=self.num_workers,
             sampler=self.train_sampler,
             drop_last=self.drop_last_sample,
-            collate_fn=self.collate_fn,
+            collate_fn=self.get_collate_fn(self.train_audio_transform),
             pin_memory=True,
         )
 
@@ -320,7 +362,7 @@ class OurDataModule(pl.LightningDataModule):
             num_workers=self.num_workers,
             sampler=self.val_sampler,
             drop_last=self.drop_last_sample,
-            collate_fn=self.collate_fn,
+            collate_fn=self.get_collate_fn(self.val_audio_transform),
             pin_memory=True,
         )
 
@@ -334,7 +376,7 @@ class OurDataModule(pl.LightningDataModule):
             num_workers=self.num_workers,
             sampler=self.test_sampler,
             drop_last=False,
-            collate_fn=self.collate_fn,
+            collate_fn=self.get_collate_fn(self.val_audio_transform),
             pin_memory=True,
         )
 
@@ -348,7 +390,7 @@ class OurDataModule(pl.LightningDataModule):
             num_workers=self.num_workers,
             sampler=self.test_sampler,
             drop_last=False,
-            collate_fn=self.collate_fn,
+            collate_fn=self.get_collate_fn(self.val_audio_transform),
             pin_memory=True,
         )
 
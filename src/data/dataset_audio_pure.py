@@ -6,6 +6,7 @@ import torch
 
 from src.data.dataset_base import DatasetBase, DatasetGetItem
 from src.features.audio_transform_base import AudioTransformBase
+from src.utils.utils_audio import resample_audio
 
 
 class PureAudioDataset(DatasetBase):
@@ -58,14 +59,12 @@ class PureAudioDataset(DatasetBase):
         audio, sampling_rate = self.dataset_path[audio_path]
         audio = librosa.to_mono(audio)
         if sampling_rate != self.sampling_rate:
-            audio = librosa.resample(
-                y=audio, orig_sr=sampling_rate, target_sr=self.sampling_rate
-            )
+            audio = resample_audio(audio, sampling_rate, self.sampling_rate)
 
         return audio, labels, audio_path
 
     def __getitem__(self, index: int) -> DatasetGetItem:
         audio, labels, _ = self.load_sample(index)
-        labels = torch.tensor(labels).float()
+        labels = torch.as_tensor(labels, dtype=torch.float32)
         features = self.audio_transform(audio)
         return features, labels, index
@@ -13,7 +13,7 @@ from torch.utils.data import Dataset
 
 import src.config.config_defaults as config_defaults
 from src.features.audio_transform_base import AudioTransformBase
-from src.utils.utils_audio import load_audio_from_file
+from src.utils.utils_audio import load_audio_batch, load_audio_from_file
 from src.utils.utils_dataset import decode_instruments, encode_instruments
 from src.utils.utils_functions import dict_without_keys
 
@@ -165,6 +165,20 @@ class DatasetBase(Dataset[DatasetGetItem]):
         )
         return audio, labels, audio_path
 
+    def load_samples(
+        self, item_indices: list[int]
+    ) -> tuple[list[np.ndarray], list[np.ndarray], list[Path]]:
+        """Same as load_sample but loads multiple audios concurrently."""
+        audio_paths, labels = zip(*[self.dataset_list[i] for i in item_indices])
+        audios_and_srs = load_audio_batch(
+            list(audio_paths),
+            target_sr=self.sampling_rate if self.need_to_resample else None,
+            method="librosa",
+            normalize=self.normalize_audio,
+        )
+        audios = [audio for audio, _ in audios_and_srs]
+        return audios, list(labels), list(audio_paths)
+
     def get_random_sample_for_instrument(self, instrument_idx: int) -> int:
         """Returns a random sample which contains the instrument with index instrument_idx."""
         instrument = config_defaults.IDX_TO_INSTRUMENT[instrument_idx]
@@ -196,20 +210,11 @@ class DatasetBase(Dataset[DatasetGetItem]):
             replace=allow_repeating_labels,
         )
 
-        negative_audios = []
-        negative_labels = []
-        negative_paths = []
-        for instrument_idx in negative_indices:
-            sample_idx = self.get_random_sample_for_instrument(instrument_idx)
-            negative_audio, negative_label, negative_path = self.load_sample(sample_idx)
-            negative_audios.append(negative_audio)
-            negative_labels.append(negative_label)
-            negative_paths.append(negative_path)
-        return negative_audios, negative_labels, negative_paths
-
-    def _pad_with_zeros(self, audio: np.ndarray, desired_size: int):
-        pad_width = (0, desired_size - len(audio))
-        return np.pad(audio, pad_width, mode="constant", constant_values=0)
+        sample_indices = [
+            self.get_random_sample_for_instrument(instrument_idx)
+            for instrument_idx in negative_indices
+        ]
+        return self.load_samples(sample_indices)
 
     def concat_and_sum(
         self,
@@ -264,15 +269,14 @@ class DatasetBase(Dataset[DatasetGetItem]):
             audios = np.array_split(audios, self.sum_n_samples)
 
         # If at this point we have more than one audio we want to sum them
-        # For summing, audios have to have equal size
-        # Pad every audio with 0 to the maximum length
+        # Shorter audios are treated as if they were padded with 0 to the maximum length. Audios
+        # are added to a single zero buffer instead of padding and stacking every audio.
         if use_sum:
             max_len = max(len(a) for a in audios)
-            for i, audio in enumerate(audios):
-                if len(audio) != max_len:
-                    audios[i] = self._pad_with_zeros(audio, max_len)
-            # Now that they are equal in size we can create numpy array
-            audios = np.mean(audios, axis=0)
+            summed_audio = np.zeros(max_len, dtype=np.result_type(*audios))
+            for audio in audios:
+                summed_audio[: len(audio)] += audio
+            audios = summed_audio / len(audios)
 
         labels = np.logical_or.reduce(labels).astype(labels[0].dtype)
         return audios, labels
@@ -313,6 +317,14 @@ class DatasetBase(Dataset[DatasetGetItem]):
         return audio, labels
 
     def __getitem__(self, index: int) -> DatasetGetItem:
+        if self.audio_transform is not None and not (self.use_concat or self.use_sum):
+            # The audio transform loads the audio only if it doesn't have cached features
+            audio_path, labels = self.dataset_list[index]
+            features = self.audio_transform.process_with_cache(
+                audio_path, load_audio=lambda: self.load_sample(index)[0]
+            )
+            return features, torch.as_tensor(labels, dtype=torch.float32), index
+
         audio, labels, _ = self.load_sample(index)
 
         if self.use_concat or self.use_sum:
@@ -321,7 +333,7 @@ class DatasetBase(Dataset[DatasetGetItem]):
         if self.audio_transform is None:
             return audio, labels, index
 
-        labels = torch.tensor(labels).float()
+        labels = torch.as_tensor(labels, dtype=torch.float32)
         features = self.audio_transform(audio)
 
         # Uncomment for playing audio
@@ -1,5 +1,10 @@
+from functools import lru_cache
+from math import ceil
+
 import numpy as np
 import torch
+import torch.nn.functional
+import torchaudio.compliance.kaldi as kaldi
 from transformers import ASTFeatureExtractor
 
 from src.config.argparse_with_config import ArgParseWithConfig
@@ -10,12 +15,26 @@ from src.config.config_defaults import (
 )
 from src.features.audio_transform_base import AudioTransformBase
 from src.utils.utils_audio import (
-    iron_audios,
+    chunk_and_iron_audio,
     plot_spectrograms,
     spec_width_to_num_samples,
 )
 from src.utils.utils_dataset import get_example_val_sample
 
+# Kaldi fbank parameters which ASTFeatureExtractor uses
+KALDI_FRAME_LENGTH_MS = 25.0
+KALDI_FRAME_SHIFT_MS = 10.0
+KALDI_PREEMPHASIS_COEFFICIENT = 0.97
+KALDI_LOW_FREQ = 20.0
+KALDI_EPSILON = torch.finfo(torch.float32).eps
+
+
+@lru_cache(maxsize=4)
+def get_ast_feature_extractor(pretrained_tag: str) -> ASTFeatureExtractor:
+    """Feature extractor config is loaded only once for every pretrained tag. The extractor is
+    read only (shared by all transforms)."""
+    return ASTFeatureExtractor.from_pretrained(pretrained_tag)
+
 
 class AudioTransformAST(AudioTransformBase):
     def __init__(
@@ -42,15 +61,42 @@ class AudioTransformAST(AudioTransformBase):
             print(
                 "Warning: inferring max_num_width_samples from AST pretrained config."
             )
-            self.feature_extractor: ASTFeatureExtractor = (
-                ASTFeatureExtractor.from_pretrained(pretrained_tag)
-            )
+            self.feature_extractor = get_ast_feature_extractor(pretrained_tag)
         self.image_size = (
             self.feature_extractor.num_mel_bins,
             self.feature_extractor.max_length,
         )
-        self.max_audio_length = spec_width_to_num_samples(
-            self.image_size[-1], self.hop_length
+        # Precompute everything that ASTFeatureExtractor recomputes for every audio
+        extractor_sr = self.feature_extractor.sampling_rate
+        assert (
+            extractor_sr == self.sampling_rate
+        ), f"Feature extractor expects {extractor_sr} Hz audio, got {self.sampling_rate} Hz"
+        self.window_size = int(extractor_sr * KALDI_FRAME_LENGTH_MS * 0.001)
+        self.window_shift = int(extractor_sr * KALDI_FRAME_SHIFT_MS * 0.001)
+        self.padded_window_size = 2 ** (self.window_size - 1).bit_length()
+        self.window = torch.hann_window(self.window_size, periodic=False)
+        mel_banks, _ = kaldi.get_mel_banks(
+            self.feature_extractor.num_mel_bins,
+            self.padded_window_size,
+            float(extractor_sr),
+            KALDI_LOW_FREQ,
+            0.0,
+            100.0,
+            -500.0,
+            1.0,
+        )
+        # Add zero column for the Nyquist frequency [n_mels, padded_window_size // 2 + 1]
+        self.mel_banks = torch.nn.functional.pad(mel_banks, (0, 1))
+        self.max_length = self.feature_extractor.max_length
+        self.do_normalize = self.feature_extractor.do_normalize
+        self.fbank_mean = self.feature_extractor.mean
+        self.fbank_std = self.feature_extractor.std
+
+        # Number of samples for which Kaldi framing (no centering) creates exactly max_length
+        # frames so that chunks are neither padded nor truncated by fbank
+        self.max_audio_length = (
+            spec_width_to_num_samples(self.max_length, self.window_shift)
+            + self.window_size
         )
 
     @staticmethod
@@ -64,6 +110,44 @@ class AudioTransformAST(AudioTransformBase):
         spectrogram = spectrogram.transpose(-2, -1)
         return spectrogram
 
+    def fbank(self, audios: list[np.ndarray] | np.ndarray) -> torch.Tensor:
+        """Vectorized ASTFeatureExtractor. Calculates Kaldi fbank features for all chunks at once
+        (one FFT and one matrix multiplication), pads/truncates them to max_length and normalizes
+        them.
+
+        Args:
+            audios: chunks which have the same length (list or [Chunks, Time] array)
+
+        Returns:
+            torch.Tensor: [Chunks, max_length, num_mel_bins]
+        """
+        waveforms = torch.from_numpy(np.asarray(audios, dtype=np.float32))
+
+        # [Chunks, Frames, window_size]
+        frames = waveforms.unfold(-1, self.window_size, self.window_shift)
+        frames = frames - frames.mean(dim=-1, keepdim=True)
+
+        # Preemphasis, the first sample of the frame is replicated
+        previous = torch.cat((frames[..., :1], frames[..., :-1]), dim=-1)
+        frames = (frames - KALDI_PREEMPHASIS_COEFFICIENT * previous) * self.window
+
+        spectrum = torch.fft.rfft(frames, n=self.padded_window_size)
+        power_spectrum = spectrum.abs().pow(2.0)
+        fbank = torch.matmul(power_spectrum, self.mel_banks.T)
+        fbank = fbank.clamp_min(KALDI_EPSILON).log()
+
+        num_frames = fbank.shape[1]
+        if num_frames < self.max_length:
+            fbank = torch.nn.functional.pad(
+                fbank, (0, 0, 0, self.max_length - num_frames)
+            )
+        else:
+            fbank = fbank[:, : self.max_length]
+
+        if self.do_normalize:
+            fbank = (fbank - self.fbank_mean) / (self.fbank_std * 2)
+        return fbank
+
     # @timeit
     def __call__(
         self, audio: torch.Tensor | np.ndarray
@@ -72,31 +156,17 @@ class AudioTransformAST(AudioTransformBase):
             audio = self.waveform_augmentation(audio)
 
         # Split waveform because feature extraction because transformer has a limit (trunc/padding). It creates fixed sized spectrogram. If audio is too long the spectrogram won't contain all of the audio.
-        if len(audio) > self.max_audio_length:
-            audio_tensors: tuple[torch.Tensor] = torch.tensor(audio).split(
-                self.max_audio_length, dim=-1
-            )
-            audio = [a.numpy() for a in audio_tensors]
-        else:
-            audio = [audio]
-
         # Kaldi requires audio's length to be at least n_fft (400)
-        # If there's only one chunk pad it with zero up to n_fft (400)
+        # If there's only one chunk it's ironed (repeated) up to max_audio_length
         # If there are multiple chunks discard the last (problematic) one
         min_waveform_length = self.n_fft
-        num_chunks = len(audio)
-        last_chunk = audio[-1]
-        last_chunk_length = len(last_chunk)
+        num_chunks = max(1, ceil(len(audio) / self.max_audio_length))
+        last_chunk_length = len(audio) - (num_chunks - 1) * self.max_audio_length
         if last_chunk_length < min_waveform_length and num_chunks > 1:
-            audio.pop()
-        else:
-            audio = iron_audios(audio, target_width=self.max_audio_length)
+            audio = audio[: (num_chunks - 1) * self.max_audio_length]
 
-        spectrogram = self.feature_extractor(
-            audio,
-            sampling_rate=self.sampling_rate,
-            return_tensors="pt",
-        )["input_values"]
+        audio = chunk_and_iron_audio(audio, target_width=self.max_audio_length)
+        spectrogram = self.fbank(audio)
         if self.spectrogram_augmentation is not None:
             spectrogram = self.spectrogram_augmentation(
                 spectrogram
@@ -106,6 +176,39 @@ class AudioTransformAST(AudioTransformBase):
         return spectrogram
 
 
+def _get_test_transform() -> AudioTransformAST:
+    return AudioTransformAST(
+        pretrained_tag=None,
+        sampling_rate=16_000,
+        hop_length=160,
+        n_fft=400,
+        n_mels=128,
+        max_num_width_samples=1024,
+        spectrogram_augmentation=None,
+        waveform_augmentation=None,
+    )
+
+
+def test_max_audio_length_frames():
+    transform = _get_test_transform()
+    waveform = torch.rand(1, transform.max_audio_length)
+    fbank = kaldi.fbank(waveform, num_mel_bins=128, sample_frequency=16_000)
+    assert fbank.shape[0] == transform.max_length
+
+    # One sample less creates one frame less
+    fbank = kaldi.fbank(waveform[:, :-1], num_mel_bins=128, sample_frequency=16_000)
+    assert fbank.shape[0] == transform.max_length - 1
+
+
+def test_fbank_equals_feature_extractor():
+    transform = _get_test_transform()
+    audios = [np.random.uniform(-1, 1, 40_000).astype(np.float32) for _ in range(2)]
+    expected = transform.feature_extractor(
+        audios, sampling_rate=16_000, return_tensors="pt"
+    ).input_values
+    assert torch.allclose(transform.fbank(audios), expected, atol=1e-3)
+
+
 if __name__ == "__main__":
     parser = ArgParseWithConfig()
     args, config, pl_args = parser.parse_args()
@@ -1,6 +1,6 @@
-import librosa
 import numpy as np
 import torch
+import torchaudio.transforms as TT
 
 from src.config.config_defaults import DEFAULT_MFCC_MEAN, DEFAULT_MFCC_STD
 from src.features.audio_transform_base import AudioTransformBase
@@ -9,7 +9,11 @@ from src.utils.utils_dataset import add_rgb_channel
 
 
 class MFCC(AudioTransformBase):
-    """Calculates MFCC (mel-frequency cepstral coefficients) from audio."""
+    """Calculates MFCC (mel-frequency cepstral coefficients) from audio.
+
+    The torchaudio MFCC module (mel filter bank and DCT matrix) is created only once and runs on
+    the device.
+    """
 
     def __init__(
         self,
@@ -21,6 +25,7 @@ class MFCC(AudioTransformBase):
         use_rgb: bool = True,
         normalize_audio=True,
         normalize_image=True,
+        device: torch.device | str = "cpu",
         *args,
         **kwargs,
     ):
@@ -33,6 +38,24 @@ class MFCC(AudioTransformBase):
         self.use_rgb = use_rgb
         self.normalize_audio = normalize_audio
         self.normalize_image = normalize_image
+        self.device = torch.device(device)
+
+        # Same parameters as librosa.feature.mfcc (slaney mel scale and norm, constant padding,
+        # power_to_db with top_db=80 and orthonormal DCT-II)
+        self.mfcc = TT.MFCC(
+            sample_rate=self.sampling_rate,
+            n_mfcc=self.n_mfcc,
+            norm="ortho",
+            log_mels=False,
+            melkwargs=dict(
+                n_fft=self.n_fft,
+                hop_length=self.hop_length,
+                n_mels=self.n_mels,
+                pad_mode="constant",
+                norm="slaney",
+                mel_scale="slaney",
+            ),
+        ).to(self.device)
 
     def __call__(
         self,
@@ -41,22 +64,14 @@ class MFCC(AudioTransformBase):
         if self.waveform_augmentation is not None:
             audio = self.waveform_augmentation(audio)
 
-        mfcc = librosa.feature.mfcc(
-            y=audio,
-            sr=self.sampling_rate,
-            n_mfcc=self.n_mfcc,
-            n_fft=self.n_fft,
-            hop_length=self.hop_length,
-            n_mels=self.n_mels,
-        )
+        audio = torch.as_tensor(audio, dtype=torch.float32, device=self.device)
+        mfcc = self.mfcc(audio)
 
         if self.normalize_image:
             mfcc = self.normalize_mfcc(mfcc)
 
         if self.spectrogram_augmentation is not None:
             mfcc = self.spectrogram_augmentation(mfcc)
-        else:
-            mfcc = torch.tensor(mfcc)
 
         mfcc_chunks = chunk_image_by_width(self.image_size, mfcc, DEFAULT_MFCC_MEAN)
 
@@ -4,14 +4,18 @@ import torch
 import torch.nn.functional
 from src.features.audio_transform_base import AudioTransformBase
 from src.features.chunking import chunk_image_by_width
+from src.utils.utils_audio import get_hann_window, get_mel_basis
 from src.config.config_defaults import (
     DEFAULT_MULTI_SPECTROGRAM_MEAN,
     DEFAULT_MULTI_SPECTROGRAM_STD
 )
 
 class MultiSpectrogram(AudioTransformBase):
-    """Resamples audio, extracts melspectrogram from audio and pads the original spectrogram to
-    dimension of spectrogram for max_num_width_samples sequence."""
+    """Extracts melspectrogram, spectral centroid and chroma from audio and stacks their chunks as
+    three channels of an image.
+
+    All three features are calculated from the same STFT.
+    """
 
     def __init__(
         self,
@@ -34,6 +38,14 @@ class MultiSpectrogram(AudioTransformBase):
         self.normalize_audio = normalize_audio
         self.normalize_image = normalize_image
 
+        # librosa recreates the filter banks and the window on every call
+        self.mel_basis = get_mel_basis(self.sampling_rate, self.n_fft, self.n_mels)
+        self.window = get_hann_window(self.n_fft)
+        # float32 frequencies, otherwise librosa calculates the spectral centroid in float64
+        self.fft_frequencies = librosa.fft_frequencies(
+            sr=self.sampling_rate, n_fft=self.n_fft
+        ).astype(np.float32)
+
     def __call__(
         self,
         audio: torch.Tensor | np.ndarray,
@@ -41,22 +53,30 @@ class MultiSpectrogram(AudioTransformBase):
         if self.waveform_augmentation is not None:
             audio = self.waveform_augmentation(audio)
 
-        melspec = librosa.feature.melspectrogram(
+        audio = np.asarray(audio, dtype=np.float32)
+        stft = librosa.stft(
             y=audio,
-            sr=self.sampling_rate,
             n_fft=self.n_fft,
             hop_length=self.hop_length,
-            n_mels=self.n_mels,
+            window=self.window,
+            pad_mode="constant",
+            dtype=np.complex64,
         )
+        magnitude = np.abs(stft)
+        power = magnitude**2
+
+        melspec = self.mel_basis @ power
+        # Spectral centroid is calculated from the magnitude, chroma from the power spectrogram
         spectral_centroid = librosa.feature.spectral_centroid(
-            y=audio, 
-            sr=self.sampling_rate, 
-            n_fft=self.n_fft, 
-            hop_length=self.hop_length
+            S=magnitude,
+            sr=self.sampling_rate,
+            n_fft=self.n_fft,
+            hop_length=self.hop_length,
+            freq=self.fft_frequencies,
         )
 
         chroma = librosa.feature.chroma_stft(
-            y=audio,
+            S=power,
             sr=self.sampling_rate,
             n_fft=self.n_fft,
             hop_length=self.hop_length,
@@ -67,9 +87,9 @@ class MultiSpectrogram(AudioTransformBase):
         # else:
         #     spectrogram = torch.tensor(spectrogram)
 
-        melspec_chunks = chunk_image_by_width(self.image_size, torch.tensor(melspec), "repeat")
-        spectral_centroid_chunks = chunk_image_by_width(self.image_size, torch.tensor(spectral_centroid), "repeat")
-        chroma_chunks = chunk_image_by_width(self.image_size, torch.tensor(chroma), "repeat")
+        melspec_chunks = chunk_image_by_width(self.image_size, torch.from_numpy(melspec), "repeat")
+        spectral_centroid_chunks = chunk_image_by_width(self.image_size, torch.from_numpy(spectral_centroid), "repeat")
+        chroma_chunks = chunk_image_by_width(self.image_size, torch.from_numpy(chroma), "repeat")
         multi_spectrogram = torch.stack([melspec_chunks, spectral_centroid_chunks, chroma_chunks]).permute(1, 0, 2, 3)
 
         if self.normalize_image:
@@ -87,8 +107,8 @@ class MultiSpectrogram(AudioTransformBase):
     @staticmethod
     def undo_normalize_spectrogram(spectrogram: torch.Tensor):
         return (
-            spectrogram * DEFAULT_MULTI_SPECTROGRAM_MEAN.view(1, 3, 1, 1)
-        ) + DEFAULT_MULTI_SPECTROGRAM_STD.view(1, 3, 1, 1)
+            spectrogram * DEFAULT_MULTI_SPECTROGRAM_STD.view(1, 3, 1, 1)
+        ) + DEFAULT_MULTI_SPECTROGRAM_MEAN.view(1, 3, 1, 1)
 
 
 if __name__ == "__main__":
@@ -1,16 +1,30 @@
+import hashlib
+import os
+import shutil
+from pathlib import Path
+from typing import Callable
+
 import librosa
 import numpy as np
 import torch
 import torch.nn.functional
 import torchvision.transforms.functional
+from torch.nn.utils.rnn import pad_sequence
+from tqdm import tqdm
 
 from src.config.config_defaults import (
     DEFAULT_MEL_SPECTROGRAM_MEAN,
     DEFAULT_MEL_SPECTROGRAM_STD,
     get_default_config,
 )
+from src.data.dataset_base import DatasetBase
 from src.features.audio_transform_base import AudioTransformBase
-from src.features.chunking import chunk_image_by_width, undo_image_chunking
+from src.features.chunking import (
+    chunk_image_by_width,
+    collate_fn_feature,
+    undo_image_chunking,
+)
+from src.utils.utils_audio import get_hann_window, get_mel_basis
 from src.utils.utils_dataset import (
     add_rgb_channel,
     get_example_val_sample,
@@ -20,7 +34,14 @@ from src.utils.utils_dataset import (
 
 class MelSpectrogram(AudioTransformBase):
     """Resamples audio, extracts melspectrogram from audio and pads the original spectrogram to
-    dimension of spectrogram for max_num_width_samples sequence."""
+    dimension of spectrogram for max_num_width_samples sequence.
+
+    The melspectrogram is calculated with torch.stft and a cached mel filter bank on the device
+    (cpu or e.g. GPU) and it's the same as librosa.feature.melspectrogram.
+
+    If cache_dir is set, melspectrograms of audios which aren't waveform augmented are saved to
+    the disk and loaded in next epochs instead of being calculated again.
+    """
 
     def __init__(
         self,
@@ -31,6 +52,9 @@ class MelSpectrogram(AudioTransformBase):
         use_rgb: bool = True,
         normalize_audio=True,
         normalize_image=True,
+        device: torch.device | str = "cpu",
+        cache_dir: Path | None = None,
+        recompute_cache: bool = False,
         *args,
         **kwargs,
     ):
@@ -42,6 +66,31 @@ class MelSpectrogram(AudioTransformBase):
         self.use_rgb = use_rgb
         self.normalize_audio = normalize_audio
         self.normalize_image = normalize_image
+        self.device = torch.device(device)
+
+        # Same filter bank (slaney) and window as librosa.feature.melspectrogram, which creates
+        # them on every call, so the normalization constants still apply
+        self.mel_basis = torch.tensor(
+            get_mel_basis(self.sampling_rate, self.n_fft, self.n_mels),
+            device=self.device,
+        )
+        self.window = torch.tensor(get_hann_window(self.n_fft), device=self.device)
+
+        self.cache_dir = None
+        if cache_dir is not None:
+            # Spectrograms for different parameters are stored in different directories
+            params = (
+                self.sampling_rate,
+                self.n_fft,
+                self.hop_length,
+                self.n_mels,
+                self.normalize_audio,
+            )
+            cache_key = hashlib.md5(str(params).encode()).hexdigest()
+            self.cache_dir = Path(cache_dir, cache_key)
+            if recompute_cache and self.cache_dir.exists():
+                shutil.rmtree(self.cache_dir)
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
 
     def __call__(
         self,
@@ -50,18 +99,135 @@ class MelSpectrogram(AudioTransformBase):
         if self.waveform_augmentation is not None:
             audio = self.waveform_augmentation(audio)
 
-        spectrogram = librosa.feature.melspectrogram(
-            y=audio,
-            sr=self.sampling_rate,
+        spectrogram = self.melspectrogram(audio)
+        return self.spectrogram_to_chunks(spectrogram)
+
+    def process_batch(
+        self,
+        audio_batch: list[torch.Tensor | np.ndarray],
+    ) -> list[torch.Tensor]:
+        """Calculates melspectrograms for the whole batch at once and returns the chunked
+        spectrogram for each audio.
+
+        Audios are padded with zeros to the longest audio and each spectrogram is cut to the number
+        of frames of its own audio afterwards.
+        """
+        if self.waveform_augmentation is not None:
+            audio_batch = [self.waveform_augmentation(audio) for audio in audio_batch]
+
+        audio_batch = [
+            torch.as_tensor(audio, dtype=torch.float32, device=self.device)
+            for audio in audio_batch
+        ]
+        audio_lengths = torch.tensor([len(audio) for audio in audio_batch])
+        audio_padded = pad_sequence(audio_batch, batch_first=True)
+        return self.process_padded_batch(audio_padded, audio_lengths)
+
+    def process_padded_batch(
+        self,
+        audio_padded: torch.Tensor,
+        audio_lengths: torch.Tensor,
+    ) -> list[torch.Tensor]:
+        """Calculates melspectrograms of zero padded audios [Batch, Time] at once and cuts each
+        spectrogram to the number of frames of its own audio. Waveform augmentations aren't
+        applied."""
+        spectrograms = self.melspectrogram(audio_padded)  # [Batch, n_mels, width]
+        num_frames = (audio_lengths // self.hop_length + 1).tolist()
+
+        return [
+            self.spectrogram_to_chunks(spectrogram[..., :width])
+            for spectrogram, width in zip(spectrograms, num_frames)
+        ]
+
+    def process_with_cache(
+        self,
+        audio_path: Path,
+        load_audio: Callable[[], np.ndarray],
+    ) -> torch.Tensor:
+        """Loads the melspectrogram from the cache (or calculates and caches it) and runs only the
+        spectrogram augmentations and chunking."""
+        if not self.use_cache():
+            return super().process_with_cache(audio_path, load_audio)
+
+        cache_path = self.get_cache_path(audio_path)
+        if cache_path.exists():
+            spectrogram = np.load(cache_path, mmap_mode="r")
+            spectrogram = torch.from_numpy(spectrogram.astype(np.float32))
+        else:
+            spectrogram = self.melspectrogram(load_audio())
+            self.save_to_cache(spectrogram, cache_path)
+        return self.spectrogram_to_chunks(spectrogram)
+
+    def precompute(self, dataset: DatasetBase):
+        """Calculates and caches melspectrograms for all audio files of the dataset which aren't
+        cached yet.
+
+        Audios are loaded with the dataset's load_sample, same as in the dataset's __getitem__, so
+        the cached melspectrograms are the same as the ones process_with_cache calculates.
+        """
+        assert self.cache_dir is not None, "Set cache_dir to precompute melspectrograms"
+        assert (
+            dataset.normalize_audio == self.normalize_audio
+        ), "Dataset and transform normalize audio differently"
+        for index, (audio_path, _) in enumerate(tqdm(dataset.dataset_list)):
+            cache_path = self.get_cache_path(audio_path)
+            if cache_path.exists():
+                continue
+            audio, _, _ = dataset.load_sample(index)
+            self.save_to_cache(self.melspectrogram(audio), cache_path)
+
+    def use_cache(self) -> bool:
+        """Spectrogram can be cached only if the waveform isn't augmented."""
+        is_waveform_augmented = (
+            self.waveform_augmentation is not None
+            and len(self.waveform_augmentation.augmentations) > 0
+        )
+        return self.cache_dir is not None and not is_waveform_augmented
+
+    def get_cache_path(self, audio_path: Path) -> Path:
+        path_hash = hashlib.md5(str(audio_path).encode()).hexdigest()
+        return Path(self.cache_dir, f"{path_hash}.npy")
+
+    def save_to_cache(self, spectrogram: torch.Tensor, cache_path: Path):
+        # float16 halves the disk usage and the reading time. The file is written under a
+        # temporary name first so that other workers never read a partially written file.
+        tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            np.save(f, spectrogram.cpu().numpy().astype(np.float16))
+        os.replace(tmp_path, cache_path)
+
+    def melspectrogram(self, audio: torch.Tensor | np.ndarray) -> torch.Tensor:
+        """Power melspectrogram of audio [Time] or audios [Batch, Time].
+
+        Tensors are processed on their own device and numpy arrays on self.device.
+        """
+        if isinstance(audio, torch.Tensor):
+            audio = audio.float()
+        else:
+            audio = torch.as_tensor(audio, dtype=torch.float32, device=self.device)
+
+        # Filter bank and window follow the audio, e.g. a batch which Lightning moved to GPU
+        if self.mel_basis.device != audio.device:
+            self.mel_basis = self.mel_basis.to(audio.device)
+            self.window = self.window.to(audio.device)
+
+        stft = torch.stft(
+            audio,
             n_fft=self.n_fft,
             hop_length=self.hop_length,
-            n_mels=self.n_mels,
+            window=self.window,
+            center=True,
+            pad_mode="constant",
+            return_complex=True,
         )
+        # |stft|^2 without the square root of abs()
+        power = stft.real.square() + stft.imag.square()
+        return torch.matmul(self.mel_basis, power)
 
+    def spectrogram_to_chunks(self, spectrogram: torch.Tensor) -> torch.Tensor:
+        """Augments, chunks and normalizes the spectrogram."""
         if self.spectrogram_augmentation is not None:
             spectrogram = self.spectrogram_augmentation(spectrogram)
-        else:
-            spectrogram = torch.tensor(spectrogram)
 
         spectrogram_chunks = chunk_image_by_width(
             self.image_size, spectrogram, "repeat"
@@ -110,6 +276,46 @@ class MelSpectrogram(AudioTransformBase):
         ) + DEFAULT_MEL_SPECTROGRAM_MEAN
 
 
+class GPUMelCollate:
+    """Moves the melspectrogram calculation from DataLoader workers to the device (e.g. GPU).
+
+    __call__ is the DataLoader's collate function (runs in workers). It only augments and zero
+    pads the waveforms. on_after_batch_transfer runs in the main process once Lightning moves the
+    padded batch to the device. It calculates the melspectrograms of the whole batch at once and
+    returns the same batch as collate_fn_feature. Dataset's audio_transform has to be None.
+
+    Used by OurDataModule when spectrogram_on_device is set. The datamodule's
+    on_after_batch_transfer hook runs for train, val, test and predict dataloaders alike, so every
+    dataloader uses GPUMelCollate then.
+    """
+
+    def __init__(self, mel_spectrogram: MelSpectrogram):
+        self.mel_spectrogram = mel_spectrogram
+
+    def __call__(
+        self, examples: list[tuple[np.ndarray, np.ndarray, int]]
+    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        audios, labels, dataset_indices = zip(*examples)
+        waveform_augmentation = self.mel_spectrogram.waveform_augmentation
+        if waveform_augmentation is not None:
+            audios = [waveform_augmentation(audio) for audio in audios]
+
+        audios = [torch.as_tensor(audio, dtype=torch.float32) for audio in audios]
+        audio_lengths = torch.tensor([len(audio) for audio in audios])
+        audio_padded = pad_sequence(audios, batch_first=True)
+        labels = torch.from_numpy(np.stack(labels)).float()
+        return audio_padded, audio_lengths, labels, torch.tensor(dataset_indices)
+
+    def on_after_batch_transfer(
+        self, batch: tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]
+    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        audio_padded, audio_lengths, labels, dataset_indices = batch
+        features = self.mel_spectrogram.process_padded_batch(
+            audio_padded, audio_lengths
+        )
+        return collate_fn_feature(list(zip(features, labels, dataset_indices)))
+
+
 def test_chunking():
     config = get_default_config()
     audio = get_example_val_sample(config.sampling_rate)
@@ -152,5 +358,90 @@ def test_chunking():
     ), "Reconstructred spectrogram isn't good"
 
 
+def _get_test_transform(**kwargs) -> MelSpectrogram:
+    return MelSpectrogram(
+        sampling_rate=16_000,
+        hop_length=160,
+        n_fft=400,
+        n_mels=128,
+        image_size=(384, 384),
+        spectrogram_augmentation=None,
+        waveform_augmentation=None,
+        **kwargs,
+    )
+
+
+def test_num_frames():
+    """process_padded_batch cuts spectrograms to len(audio) // hop_length + 1 frames, so
+    process_batch returns the same features as the transform of each audio."""
+    transform = _get_test_transform()
+    n_fft, hop_length = transform.n_fft, transform.hop_length
+    for num_samples in [n_fft, 10_000, 44_100, 44_100 + hop_length - 1]:
+        spectrogram = librosa.feature.melspectrogram(
+            y=np.zeros(num_samples, dtype=np.float32),
+            sr=transform.sampling_rate,
+            n_fft=n_fft,
+            hop_length=hop_length,
+            n_mels=transform.n_mels,
+        )
+        assert spectrogram.shape[-1] == num_samples // hop_length + 1
+
+    audios = [
+        np.random.uniform(-1, 1, size).astype(np.float32) for size in [10_000, 44_100]
+    ]
+    for batch_features, features in zip(
+        transform.process_batch(audios), [transform(audio) for audio in audios]
+    ):
+        assert torch.allclose(batch_features, features)
+
+
+def test_gpu_mel_collate():
+    """GPUMelCollate returns the same batch as collate_fn_feature over per-item features."""
+    transform = _get_test_transform()
+    collate = GPUMelCollate(transform)
+    examples = [
+        (
+            np.random.uniform(-1, 1, size).astype(np.float32),
+            np.eye(3, dtype=np.float32)[i],
+            i,
+        )
+        for i, size in enumerate([10_000, 44_100])
+    ]
+    batch = collate.on_after_batch_transfer(collate(examples))
+    expected = collate_fn_feature(
+        [
+            (transform(audio), torch.from_numpy(label), index)
+            for audio, label, index in examples
+        ]
+    )
+    for batch_tensor, expected_tensor in zip(batch, expected):
+        assert torch.allclose(batch_tensor, expected_tensor)
+
+    # Features are calculated on the device of the transferred batch
+    if torch.cuda.is_available():
+        cuda_batch = tuple(tensor.cuda() for tensor in collate(examples))
+        features = collate.on_after_batch_transfer(cuda_batch)[0]
+        assert features.is_cuda
+
+
+def test_cache_round_trip(tmp_path: Path):
+    """Melspectrograms loaded from the float16 cache are close to the calculated ones."""
+    transform = _get_test_transform(cache_dir=tmp_path)
+    audio = np.random.uniform(-1, 1, 44_100).astype(np.float32)
+    audio_path = Path("audio.wav")
+
+    features = transform.process_with_cache(audio_path, load_audio=lambda: audio)
+    cache_path = transform.get_cache_path(audio_path)
+    assert cache_path.exists()
+
+    spectrogram = transform.melspectrogram(audio)
+    cached_spectrogram = torch.from_numpy(np.load(cache_path).astype(np.float32))
+    assert torch.allclose(cached_spectrogram, spectrogram, rtol=1e-3, atol=1e-6)
+
+    # Second call reads the cache and doesn't load the audio
+    cached_features = transform.process_with_cache(audio_path, load_audio=None)
+    assert torch.allclose(cached_features, features, rtol=1e-3, atol=1e-3)
+
+
 if __name__ == "__main__":
     pass
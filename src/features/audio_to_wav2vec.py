@@ -1,9 +1,29 @@
+from functools import lru_cache
+
 import numpy as np
 import torch
 from transformers import Wav2Vec2FeatureExtractor
 
 from src.features.audio_transform_base import AudioTransformBase
-from src.utils.utils_audio import iron_audios
+from src.utils.utils_audio import chunk_and_iron_audio
+
+WAV2VEC2_NORM_EPSILON = 1e-7
+
+
+@lru_cache(maxsize=4)
+def get_wav2vec2_feature_extractor(pretrained_tag: str) -> Wav2Vec2FeatureExtractor:
+    """Feature extractor config is loaded only once for every pretrained tag. The extractor is
+    read only (shared by all transforms)."""
+    return Wav2Vec2FeatureExtractor.from_pretrained(pretrained_tag)
+
+
+def zero_mean_unit_var_norm(audios: torch.Tensor) -> torch.Tensor:
+    """Normalizes every audio (row) to zero mean and unit variance. Same as
+    Wav2Vec2FeatureExtractor.zero_mean_unit_var_norm for audios of equal length (no attention
+    mask) but vectorized over the whole batch."""
+    mean = audios.mean(dim=-1, keepdim=True)
+    var = audios.var(dim=-1, unbiased=False, keepdim=True)
+    return (audios - mean) / torch.sqrt(var + WAV2VEC2_NORM_EPSILON)
 
 
 class AudioToWav2Vec2(AudioTransformBase):
@@ -16,7 +36,8 @@ class AudioToWav2Vec2(AudioTransformBase):
     ):
         super().__init__(*args, **kwargs)
         self.max_num_width_samples = max_num_width_samples
-        self.processor = Wav2Vec2FeatureExtractor.from_pretrained(pretrained_tag)
+        self.processor = get_wav2vec2_feature_extractor(pretrained_tag)
+        self.do_normalize = self.processor.do_normalize
 
     def __call__(
         self, audio: torch.Tensor | np.ndarray
@@ -24,23 +45,22 @@ class AudioToWav2Vec2(AudioTransformBase):
         if self.waveform_augmentation is not None:
             audio = self.waveform_augmentation(audio)
 
-        if len(audio) > self.max_num_width_samples:
-            audio_tensors: tuple[torch.Tensor] = torch.tensor(audio).split(
-                self.max_num_width_samples, dim=-1
-            )
-            audio = [a.numpy() for a in audio_tensors]
-        else:
-            audio = [audio]
-
-        audio = iron_audios(audio, target_width=self.max_num_width_samples)
-
-        processor_out = self.processor(
-            audio, sampling_rate=self.sampling_rate, return_tensors="pt", padding=True
-        )
+        audio = chunk_and_iron_audio(audio, target_width=self.max_num_width_samples)
 
-        processed_audio = processor_out.input_values
+        # All chunks have equal length after ironing so there's no padding or attention mask and
+        # the processor would only normalize each chunk.
+        processed_audio = torch.from_numpy(audio)
+        if self.do_normalize:
+            processed_audio = zero_mean_unit_var_norm(processed_audio)
 
         # note: confirmed that listening to unnormalized audio (do_normalize=False) sounds good.
         assert len(processed_audio.shape) == 2
 
         return processed_audio
+
+
+def test_zero_mean_unit_var_norm():
+    audios = np.random.uniform(-1, 1, size=(3, 16_000)).astype(np.float32)
+    expected = Wav2Vec2FeatureExtractor.zero_mean_unit_var_norm(list(audios), None)
+    normalized = zero_mean_unit_var_norm(torch.from_numpy(audios))
+    assert torch.allclose(normalized, torch.tensor(np.stack(expected)), atol=1e-5)
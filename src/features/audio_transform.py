@@ -40,6 +40,9 @@ def get_audio_transform(
         )
     elif audio_transform_enum is AudioTransforms.MEL_SPECTROGRAM:
         return MelSpectrogram(
+            normalize_audio=config.normalize_audio,
+            cache_dir=config.spectrogram_cache_dir,
+            recompute_cache=config.recompute_spectrogram_cache,
             **image_kwargs,
             **base_kwargs,
         )
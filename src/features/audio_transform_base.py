@@ -1,6 +1,6 @@
 from abc import ABC, abstractmethod
 from pathlib import Path
-from typing import Literal
+from typing import Callable, Literal
 
 import numpy as np
 import torch
@@ -45,6 +45,35 @@ class AudioTransformBase(ABC):
             tuple[torch.Tensor, torch.Tensor]: _description_
         """
 
+    def process_batch(
+        self,
+        audio_batch: list[torch.Tensor | np.ndarray],
+    ) -> list[torch.Tensor]:
+        """Creates features for every audio in the batch. Transforms which can process the whole
+        batch at once (e.g. a single STFT over padded audios) override this function.
+
+        Args:
+            audio_batch: list of audios which can have different lengths
+
+        Returns:
+            list[torch.Tensor]: features of each audio
+        """
+        return [self(audio) for audio in audio_batch]
+
+    def process_with_cache(
+        self,
+        audio_path: Path,
+        load_audio: Callable[[], np.ndarray],
+    ) -> torch.Tensor:
+        """Creates features for the audio file. Transforms which cache features override this
+        function and call load_audio() only if the features aren't cached.
+
+        Args:
+            audio_path: audio file path, used as the cache key
+            load_audio: function which loads the audio
+        """
+        return self(load_audio())
+
     def process_from_file(
         self,
         audio_file_path: Path,
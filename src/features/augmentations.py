@@ -1,20 +1,49 @@
+import itertools
+import os
 from pathlib import Path
 from typing import Callable
 
-import librosa
 import numpy as np
 import pyloudnorm
 import torch
 import torch_audiomentations as TA
-import torchaudio.transforms as TT
+import torchaudio
 from torchvision.transforms import RandomErasing
 
 from src.config.config_defaults import ConfigDefault
 from src.enums.enums import SupportedAugmentations
-from src.utils.utils_audio import time_mask_audio
-
-
-class WaveformAugmentation:
+from src.utils.utils_audio import stretch_audio, time_mask_audio
+
+
+class ProcessRandomGenerator:
+    """Provides a numpy random generator which belongs to the instance, so sampling doesn't go
+    through the global numpy random state.
+
+    DataLoader workers get a copy of the instance, so the generator is recreated (and seeded with
+    torch's seed, which is different for each worker) once in every process. Otherwise all workers
+    would sample the same values. The seed is salted with an instance number so that different
+    instances (e.g. waveform and spectrogram augmentation) in the same worker don't sample the
+    same values either.
+    """
+
+    _rng: np.random.Generator | None = None
+    _rng_pid: int | None = None
+    _rng_salt: int | None = None
+    _rng_salts = itertools.count()
+
+    @property
+    def rng(self) -> np.random.Generator:
+        pid = os.getpid()
+        if self._rng is None or self._rng_pid != pid:
+            if self._rng_salt is None:
+                self._rng_salt = next(ProcessRandomGenerator._rng_salts)
+            seed = np.random.SeedSequence([torch.initial_seed(), self._rng_salt])
+            self._rng = np.random.default_rng(seed)
+            self._rng_pid = pid
+        return self._rng
+
+
+class WaveformAugmentation(ProcessRandomGenerator):
     def __init__(
         self,
         augmentations: list[SupportedAugmentations],
@@ -43,6 +72,7 @@ class WaveformAugmentation:
                 max_snr_in_db=30,
                 p=1,
                 sample_rate=self.sampling_rate,
+                output_type="dict",
             )
 
         except Exception:
@@ -54,6 +84,7 @@ class WaveformAugmentation:
         self.timeinv = TA.PolarityInversion(
             p=time_inversion_p,
             sample_rate=self.sampling_rate,
+            output_type="dict",
         )
 
         self.pitch = TA.PitchShift(
@@ -61,8 +92,27 @@ class WaveformAugmentation:
             max_transpose_semitones=2,
             p=1,
             sample_rate=self.sampling_rate,
+            output_type="dict",
+        )
+
+        # Consecutive torch_audiomentations augmentations are applied with a single Compose call
+        pre_stretch_augmentations = []
+        if (
+            SupportedAugmentations.BACKGROUND_NOISE in self.augmentations
+            and self.background_noise is not None
+        ):
+            pre_stretch_augmentations.append(self.background_noise)
+        if SupportedAugmentations.TIMEINV in self.augmentations:
+            pre_stretch_augmentations.append(self.timeinv)
+        if SupportedAugmentations.PITCH in self.augmentations:
+            pre_stretch_augmentations.append(self.pitch)
+        self.pre_stretch_augmentations = (
+            TA.Compose(pre_stretch_augmentations, output_type="tensor")
+            if len(pre_stretch_augmentations) > 0
+            else None
         )
         self.stretch_factors = stretch_factors
+        self.loudness_meter = pyloudnorm.Meter(self.sampling_rate)
 
         self.time_shift = TA.Shift(
             min_shift=-0.5,
@@ -71,6 +121,24 @@ class WaveformAugmentation:
             sample_rate=self.sampling_rate,
         )
 
+        # Enabled augmentations in the order in which they are applied, so that __call__ doesn't
+        # check every augmentation for every audio
+        pipeline: list[tuple[bool, Callable]] = [
+            (self.pre_stretch_augmentations is not None, self.apply_pre_stretch),
+            (SupportedAugmentations.TIME_STRETCH in augmentations, self.apply_stretch),
+            (SupportedAugmentations.TIME_SHIFT in augmentations, self.apply_time_shift),
+            (
+                SupportedAugmentations.NORM_AFTER_TIME_AUGS in augmentations,
+                self.apply_loudness_norm,
+            ),
+            (
+                SupportedAugmentations.COLOR_NOISE in augmentations,
+                self.apply_color_noise,
+            ),
+            (SupportedAugmentations.TIME_MASK in augmentations, self.apply_time_mask),
+        ]
+        self.pipeline = [function for enabled, function in pipeline if enabled]
+
     def to_type(self, audio: torch.Tensor | np.ndarray, t: Callable):
         """Converts audio to torch or numpy (only if needed)"""
         if isinstance(audio, torch.Tensor) and t == np.array:
@@ -83,56 +151,49 @@ class WaveformAugmentation:
         return audio.squeeze(0).squeeze(0).numpy()
 
     def to_torch(self, audio: np.ndarray) -> torch.Tensor:
-        return torch.tensor(audio).unsqueeze(0).unsqueeze(0)
+        return torch.tensor(audio, dtype=torch.float32).unsqueeze(0).unsqueeze(0)
 
     def __call__(self, audio: np.ndarray) -> np.ndarray:
         if len(self.augmentations) == 0:
             return audio
 
-        if (
-            SupportedAugmentations.BACKGROUND_NOISE in self.augmentations
-            and self.background_noise is not None
-        ):
-            audio = self.to_type(audio, torch.tensor)
-            audio = self.background_noise(audio, sample_rate=self.sampling_rate)
-
-        if SupportedAugmentations.TIMEINV in self.augmentations:
-            audio = self.to_type(audio, torch.tensor)
-            audio = self.timeinv(audio, sample_rate=self.sampling_rate)
+        for augmentation in self.pipeline:
+            audio = augmentation(audio)
 
-        if SupportedAugmentations.PITCH in self.augmentations:
-            audio = self.to_type(audio, torch.tensor)
-            audio = self.pitch(audio, sample_rate=self.sampling_rate)
+        audio = self.to_type(audio, np.array)
+        return audio
 
-        if SupportedAugmentations.TIME_STRETCH in self.augmentations:
-            audio = self.to_type(audio, np.array)
-            random_rate = np.random.uniform(*self.stretch_factors)
-            audio = librosa.effects.time_stretch(audio, rate=random_rate)
+    def apply_pre_stretch(self, audio: torch.Tensor | np.ndarray) -> torch.Tensor:
+        """Background noise, time inversion and pitch shift."""
+        audio = self.to_type(audio, torch.tensor)
+        return self.pre_stretch_augmentations(audio, sample_rate=self.sampling_rate)
 
-        if SupportedAugmentations.TIME_SHIFT in self.augmentations:
-            audio = self.to_type(audio, torch.tensor)
-            audio = self.time_shift(audio, sample_rate=self.sampling_rate)
+    def apply_stretch(self, audio: torch.Tensor | np.ndarray) -> torch.Tensor:
+        audio = self.to_type(audio, torch.tensor)
+        random_rate = self.rng.uniform(*self.stretch_factors)
+        return stretch_audio(audio, rate=random_rate)
 
-        if SupportedAugmentations.NORM_AFTER_TIME_AUGS in self.augmentations:
-            audio = self.to_type(audio, np.array)
-            meter = pyloudnorm.Meter(self.sampling_rate)
-            loudness = meter.integrated_loudness(audio)
-            audio = pyloudnorm.normalize.loudness(audio, loudness, -12)
+    def apply_time_shift(self, audio: torch.Tensor | np.ndarray) -> torch.Tensor:
+        audio = self.to_type(audio, torch.tensor)
+        return self.time_shift(audio, sample_rate=self.sampling_rate)
 
-        if SupportedAugmentations.COLOR_NOISE in self.augmentations:
-            audio = self.to_type(audio, torch.tensor)
-            audio = self.color_noise(audio)
+    def apply_loudness_norm(self, audio: torch.Tensor | np.ndarray) -> np.ndarray:
+        audio = self.to_type(audio, np.array)
+        loudness = self.loudness_meter.integrated_loudness(audio)
+        audio = pyloudnorm.normalize.loudness(audio, loudness, -12)
+        return audio.astype(np.float32)  # pyloudnorm returns float64
 
-        if SupportedAugmentations.TIME_MASK in self.augmentations:
-            audio = self.to_type(audio, np.array)
-            percentage = np.random.uniform(0, self.time_mask_max_percentage)
-            audio = time_mask_audio(audio, percentage)
+    def apply_color_noise(self, audio: torch.Tensor | np.ndarray) -> torch.Tensor:
+        audio = self.to_type(audio, torch.tensor)
+        return self.color_noise(audio)
 
+    def apply_time_mask(self, audio: torch.Tensor | np.ndarray) -> np.ndarray:
         audio = self.to_type(audio, np.array)
-        return audio
+        percentage = self.rng.uniform(0, self.time_mask_max_percentage)
+        return time_mask_audio(audio, percentage)
 
 
-class SpectrogramAugmentation:
+class SpectrogramAugmentation(ProcessRandomGenerator):
     def __init__(
         self,
         augmentations: list[SupportedAugmentations],
@@ -146,15 +207,38 @@ class SpectrogramAugmentation:
         self.sampling_rate = sampling_rate
         self.hide_random_pixels_p = hide_random_pixels_p
         self.std_noise = std_noise
-        self.freq_mask = TT.FrequencyMasking(freq_mask_param=freq_mask_param)
-        self.random_erase = RandomErasing(scale=(0.02, 0.2), ratio=(1, 2), p=1)
+        self.freq_mask_param = freq_mask_param
+        self.random_erase_scale = (0.02, 0.2)
+        self.random_erase_ratio = (1, 2)
+        self.mask_augmentations = {
+            SupportedAugmentations.RANDOM_PIXELS,
+            SupportedAugmentations.FREQ_MASK,
+            SupportedAugmentations.RANDOM_ERASE,
+        }.intersection(self.augmentations)
+
+        # Random pixels create the mask, other enabled augmentations are added to it in order
+        self.use_random_pixels = SupportedAugmentations.RANDOM_PIXELS in augmentations
+        pipeline: list[tuple[bool, Callable]] = [
+            (SupportedAugmentations.FREQ_MASK in augmentations, self.add_freq_mask),
+            (SupportedAugmentations.RANDOM_ERASE in augmentations, self.add_erase_mask),
+        ]
+        self.mask_pipeline = [function for enabled, function in pipeline if enabled]
+
+    def freq_mask_band(self, num_freqs: int) -> tuple[int, int]:
+        """Samples the frequency band the same way as torchaudio's FrequencyMasking."""
+        value = torch.rand(1) * self.freq_mask_param
+        min_value = torch.rand(1) * (num_freqs - value)
+        start = int(min_value)
+        end = start + int(value)
+        # If freq_mask_param > num_freqs the start can be negative, torchaudio masks [0, end)
+        return max(start, 0), min(end, num_freqs)
 
     # @timeit
     def __call__(self, spectrogram: torch.Tensor | np.ndarray) -> torch.Tensor:
         if isinstance(spectrogram, np.ndarray):
-            spectrogram = torch.tensor(spectrogram)
+            spectrogram = torch.from_numpy(spectrogram)
 
-        if len(self.augmentations) == 0:
+        if len(self.mask_augmentations) == 0:
             return spectrogram
 
         return_batch_dim = True
@@ -163,24 +247,44 @@ class SpectrogramAugmentation:
             return_batch_dim = False
             spectrogram = spectrogram.unsqueeze(0)
 
-        if SupportedAugmentations.RANDOM_PIXELS in self.augmentations:
-            hide_random_pixels_p = np.random.uniform(0, 0.3)
-            mask = (
-                torch.FloatTensor(*spectrogram.shape).uniform_() < hide_random_pixels_p
-            )
-            spectrogram[mask] = 0
+        # Every augmentation sets pixels to 0 so they are merged into one mask which is applied
+        # once instead of passing over the spectrogram for each augmentation.
+        if self.use_random_pixels:
+            mask = self.random_pixels_mask(spectrogram)
+        else:
+            mask = torch.zeros_like(spectrogram, dtype=torch.bool)
 
-        if SupportedAugmentations.FREQ_MASK in self.augmentations:
-            spectrogram = self.freq_mask(spectrogram)
+        for add_mask in self.mask_pipeline:
+            add_mask(spectrogram, mask)
 
-        if SupportedAugmentations.RANDOM_ERASE in self.augmentations:
-            spectrogram = self.random_erase(spectrogram)
+        spectrogram = spectrogram.masked_fill_(mask, 0)
 
         if not return_batch_dim:
             return spectrogram.squeeze(0)
 
         return spectrogram
 
+    def random_pixels_mask(self, spectrogram: torch.Tensor) -> torch.Tensor:
+        hide_random_pixels_p = self.rng.uniform(0, 0.3)
+        # Sampled directly as bool, without a float tensor of random values
+        mask = torch.empty_like(spectrogram, dtype=torch.bool)
+        return mask.bernoulli_(hide_random_pixels_p)
+
+    def add_freq_mask(self, spectrogram: torch.Tensor, mask: torch.Tensor):
+        start, end = self.freq_mask_band(spectrogram.shape[-2])
+        mask[..., start:end, :] = True
+
+    def add_erase_mask(self, spectrogram: torch.Tensor, mask: torch.Tensor):
+        i, j, h, w, value = RandomErasing.get_params(
+            spectrogram,
+            scale=self.random_erase_scale,
+            ratio=self.random_erase_ratio,
+            value=[0],
+        )
+        # get_params returns the image itself if it didn't find the area to erase
+        if value is not spectrogram:
+            mask[..., i : i + h, j : j + w] = True
+
 
 def get_augmentations(config: ConfigDefault):
     train_kwargs = dict(
@@ -200,3 +304,23 @@ def get_augmentations(config: ConfigDefault):
         val_spectrogram_augmentation,
         val_waveform_augmentation,
     )
+
+
+def test_freq_mask_equals_torchaudio():
+    num_freqs = 20
+    for freq_mask_param in [10, 30]:
+        augmentation = SpectrogramAugmentation(
+            augmentations=[SupportedAugmentations.FREQ_MASK],
+            sampling_rate=16_000,
+            freq_mask_param=freq_mask_param,
+            hide_random_pixels_p=0,
+            std_noise=0,
+        )
+        for seed in range(20):
+            spectrogram = torch.ones(1, num_freqs, 50)
+            torch.manual_seed(seed)
+            expected = torchaudio.functional.mask_along_axis(
+                spectrogram.clone(), freq_mask_param, mask_value=0, axis=1
+            )
+            torch.manual_seed(seed)
+            assert torch.equal(augmentation(spectrogram.clone()), expected)
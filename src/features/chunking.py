@@ -1,10 +1,12 @@
 from math import ceil
 
+import numpy as np
 import torch
 import torch.nn.functional
 import torchvision.transforms.functional
 
 from src.config.config_defaults import NUM_RGB_CHANNELS
+from src.features.audio_transform_base import AudioTransformBase
 
 
 def chunk_image_by_width(
@@ -20,29 +22,29 @@ def chunk_image_by_width(
         |                                        |
         |========================================|
 
-        Step 1: scale height only
-        (384 x 1024)
-        |========================================|
-        |                                        |
-        |                                        |
-        |========================================|
-
-        Step 2: split image
-        |==============|==============|==========|
-        |  (384, 384)  |  (384, 384)  |(384, 256)|
-        |              |              |          |
-        |==============|==============|==========|
-
-        Step 3a): pad with zeros on the right
+        Step 1a): pad with zeros on the right to a multiple of the width
+        (128 x 1152)
+        |========================================|===|
+        |                                        |0 0|
+        |========================================|===|
+
+        Step 1b): repeat with first chunk to a multiple of the width
+        (128 x 1152)
+        |========================================|===|
+        |                                        |x x|
+        |========================================|===|
+
+        Step 2: scale height only (once, for the whole image)
+        (384 x 1152)
+        |============================================|
+        |                                            |
+        |                                            |
+        |============================================|
+
+        Step 3: split image (single reshape)
         |==============|==============|==============|
-        |  (384, 384)  |  (384, 384)  |  (384, 384)0 |
-        |              |              |            0 |
-        |==============|==============|==============|
-
-        Step 3b): repeat with first chunk
-        |==============|==============|==============|
-        |x (384, 384)  |  (384, 384)  |  (384, 384)x |
-        |x             |              |            x |
+        |  (384, 384)  |  (384, 384)  |  (384, 384)  |
+        |              |              |              |
         |==============|==============|==============|
 
         Returns 3x (384, 384)
@@ -57,25 +59,21 @@ def chunk_image_by_width(
         |    |
         |====|
 
-        Step 1: scale height only
-        (384 x 100)
-        |====|
-        |    |
-        |    |
-        |====|
-
-        Step 2: repeat images
-        |====================|
-        | 100  100  100  100 |
-        |                    |
-        |====================|
-
-        Step 3: cut excess
+        Step 1: repeat image and cut excess
+        (128 x 384)
         |=================|
         |100  100  100  84|
+        |=================|
+
+        Step 2: scale height only
+        (384 x 384)
+        |=================|
+        |                 |
         |                 |
         |=================|
 
+        Step 3: split image
+
         Returns 1x (384, 384)
     """
 
@@ -85,59 +83,54 @@ def chunk_image_by_width(
     # [Batch, height, width] = [1, 128, 1024]
     image = image.unsqueeze(0)
 
-    # Scale only the height (freqs) and don't touch the width (time) because the `time` will get chunked.
+    # Padding is done before resizing, while the image still has the original (usually smaller)
+    # height. Resizing changes only the height (nearest) so the result is the same as resizing
+    # first and padding the last chunk afterwards, but the padding touches fewer pixels and the
+    # resized image is created only once.
     full_width = image.shape[-1]
-    pre_resize_height = image_height  # change the height!
-    pre_resize_width = full_width  # don't change the width!
-
-    # [1, 384, 2048]
-    # [Batch, height, width]
-    interpolation = torchvision.transforms.functional.InterpolationMode.NEAREST_EXACT
-    image = torchvision.transforms.functional.resize(
-        image,
-        size=(pre_resize_height, pre_resize_width),
-        interpolation=interpolation,
-        antialias=False,
-    )
-
-    # Chunk by last dimension (width)
-    # list([1, 384, 384]), length = 5
-    # list([batch, height, width]), length = full_width // image_width
-    chunks = list(image.split(image_width, dim=-1))
     # Last chunk might be cut off which means the time dimension (image width) will be smaller
-    # Add zero padding if last chunk's width is shorter than image width
-    last_chunk = chunks[-1]  # [Batch]
-    last_chunk_width = last_chunk.shape[-1]
-    diff = image_width - last_chunk_width  # e.g. 384 - 200 = 184
+    diff = -full_width % image_width  # e.g. 384 - 200 = 184
     if diff > 0 and type(pad_value) is int or type(pad_value) is float:
         # we add 0 pads on the left, and diff on the right side, pad=(padding_left,padding_right)
-        chunks[-1] = torch.nn.functional.pad(
-            input=last_chunk, pad=(0, diff), mode="constant", value=pad_value
+        image = torch.nn.functional.pad(
+            input=image, pad=(0, diff), mode="constant", value=pad_value
         )
 
     elif diff > 0 and type(pad_value) is str:
         # Take the first chunk, glue it to the last (which is shorter).
         # If first chunk is last chunk then repeat it until the size is large enough.
         # diff = 384 - 50 = 334
-        first_chunk: torch.Tensor = chunks[0]  # [384, 50] if first chunk == first chunk
+        first_chunk = image[..., :image_width]  # [128, 50] if first chunk == last chunk
         first_chunk_width = first_chunk.shape[-1]  # 50
         num_first_chunk_repeats = max(1, ceil(diff / first_chunk_width))  # 8
         repeated_first_chunk = torch.cat(
             [first_chunk] * num_first_chunk_repeats, dim=-1
-        )  # [384, 334]
+        )  # [128, 400]
 
         # Remove remove excess width caused by repeating
-        repeated_first_chunk = repeated_first_chunk[..., :diff]  # [384, 334]
-        chunks[-1] = torch.cat((chunks[-1], repeated_first_chunk), dim=-1)  # [384, 384]
+        repeated_first_chunk = repeated_first_chunk[..., :diff]  # [128, 334]
+        image = torch.cat((image, repeated_first_chunk), dim=-1)
 
-    if len(chunks) == 1:
-        return chunks[0].float()
+    # Scale only the height (freqs) and don't touch the width (time) because the `time` will get chunked.
+    # [1, 384, 2048]
+    # [Batch, height, width]
+    if image.shape[-2] != image_height:
+        interpolation = (
+            torchvision.transforms.functional.InterpolationMode.NEAREST_EXACT
+        )
+        image = torchvision.transforms.functional.resize(
+            image,
+            size=(image_height, image.shape[-1]),
+            interpolation=interpolation,
+            antialias=False,
+        )
 
-    # list([1, 384, 384], [1, 384, 384], ...) -> [5, 384, 384]
-    # list([Batch, height, width]) -> ([Batch + chunks, height, width])
-    chunks = torch.stack(chunks, dim=1).squeeze(0).float()
-    chunks = chunks.float()
-    return chunks
+    # Chunk by last dimension (width) with a single reshape instead of split + stack
+    # [1, 384, 1920] -> [384, 5, 384] -> [5, 384, 384]
+    # [Batch, height, width] -> [height, chunks, width] -> [chunks, height, width]
+    num_chunks = image.shape[-1] // image_width
+    chunks = image.squeeze(0).unflatten(-1, (num_chunks, image_width)).movedim(-2, 0)
+    return chunks.contiguous().float()
 
 
 def undo_image_chunking(spectrogram: torch.Tensor, n_mel_bins: int) -> torch.Tensor:
@@ -175,11 +168,13 @@ def collate_fn_feature(
     example_label = example_item[1]
     feature_shape = tuple(example_feature.shape[1:])
 
-    # Create empty matrices
-    features = torch.empty((num_features, *feature_shape))
-    labels = torch.empty((num_features, example_label.shape[-1]))
-    file_indices = torch.empty(num_features, dtype=torch.int64)
-    item_indices = torch.empty(num_features, dtype=torch.int64)
+    # Create empty matrices (on the features' device, which isn't cpu if features were calculated
+    # after the batch transfer)
+    device = example_feature.device
+    features = torch.empty((num_features, *feature_shape), device=device)
+    labels = torch.empty((num_features, example_label.shape[-1]), device=device)
+    file_indices = torch.empty(num_features, dtype=torch.int64, device=device)
+    item_indices = torch.empty(num_features, dtype=torch.int64, device=device)
 
     features_passed = 0
     for unique_file_idx, item in enumerate(examples):
@@ -191,14 +186,37 @@ def collate_fn_feature(
 
         features[start:end] = feature_chunks
         labels[start:end] = label
-        file_indices[start:end] = torch.full((num_chunks,), unique_file_idx)
-        item_indices[start:end] = torch.full((num_chunks,), int(dataset_index))
+        file_indices[start:end] = unique_file_idx
+        item_indices[start:end] = int(dataset_index)
 
         features_passed += num_chunks
 
     return features, labels, file_indices, item_indices
 
 
+class CollateFnAudioBatch:
+    """Collate function for datasets which return audios (Dataset's audio_transform is None).
+
+    Features are created by calling audio_transform.process_batch once per batch instead of once
+    per item. Chunks are then collated with collate_fn_feature. Used by OurDataModule when
+    batch_audio_transform is set.
+    """
+
+    def __init__(self, audio_transform: AudioTransformBase):
+        self.audio_transform = audio_transform
+
+    def __call__(
+        self, examples: list[tuple[np.ndarray, np.ndarray, int]]
+    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        audios, labels, dataset_indices = zip(*examples)
+        features = self.audio_transform.process_batch(list(audios))
+        examples = [
+            (feature, torch.as_tensor(label, dtype=torch.float32), dataset_index)
+            for feature, label, dataset_index in zip(features, labels, dataset_indices)
+        ]
+        return collate_fn_feature(examples)
+
+
 def test_collate_fn_feature():
     num_chunks = 3
     image_width = 384
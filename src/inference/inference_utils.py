@@ -117,7 +117,7 @@ def inference_loop(
     step_type: str,
 ) -> Iterator[dict]:
     for batch_idx, batch in tqdm(enumerate(data_loader), total=len(data_loader)):
-        batch = [e.to(device) for e in batch]
+        batch = [e.to(device, non_blocking=True) for e in batch]
         with torch.no_grad():
             step_dict = model._step(
                 batch,
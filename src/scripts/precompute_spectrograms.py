@@ -0,0 +1,56 @@
+"""python3 src/scripts/precompute_spectrograms.py --audio-transform MEL_SPECTROGRAM
+--spectrogram-cache-dir data/spectrogram_cache --train-paths irmastrain:data/irmas/train
+--val-paths irmastest:data/irmas/test
+"""
+from src.config.argparse_with_config import ArgParseWithConfig
+from src.data.datamodule import OurDataModule
+from src.enums.enums import AudioTransforms
+from src.features.audio_transform import get_audio_transform
+from src.features.chunking import collate_fn_feature
+
+
+def parse():
+    parser = ArgParseWithConfig()
+    args, config, pl_args = parser.parse_args()
+    config.required_audio_transform()
+    assert (
+        config.audio_transform is AudioTransforms.MEL_SPECTROGRAM
+    ), "Only melspectrograms can be cached"
+    assert config.spectrogram_cache_dir is not None, "Set --spectrogram-cache-dir"
+    return args, config
+
+
+if __name__ == "__main__":
+    args, config = parse()
+    transform = get_audio_transform(
+        config, spectrogram_augmentation=None, waveform_augmentation=None
+    )
+    datamodule = OurDataModule(
+        train_paths=config.train_paths,
+        val_paths=config.val_paths,
+        test_paths=config.test_paths,
+        batch_size=config.batch_size,
+        num_workers=config.num_workers,
+        dataset_fraction=config.dataset_fraction,
+        drop_last_sample=False,
+        train_audio_transform=transform,
+        val_audio_transform=transform,
+        collate_fn=collate_fn_feature,
+        normalize_audio=config.normalize_audio,
+        normalize_image=config.normalize_image,
+        train_only_dataset=config.train_only_dataset,
+        concat_n_samples=None,
+        sum_n_samples=None,
+        use_weighted_train_sampler=False,
+        sampling_rate=config.sampling_rate,
+        train_override_csvs=config.train_override_csvs,
+    )
+
+    for dataset_paths in [config.train_paths, config.val_paths, config.test_paths]:
+        concat_dataset = datamodule.concat_datasets_from_tuples(
+            dataset_paths, transform
+        )
+        if concat_dataset is None:
+            continue
+        for dataset in concat_dataset.datasets:
+            transform.precompute(dataset)
@@ -169,7 +169,7 @@ if __name__ == "__main__":
     print("Saving embeddings to directory:", embedding_dir)
 
     for batch in tqdm(data_loader, total=len(data_loader)):
-        batch = [t.to(device) for t in batch]
+        batch = [t.to(device, non_blocking=True) for t in batch]
         spectrogram, multihot_labels, file_indices, item_indices = batch
 
         # Get exact label n label number
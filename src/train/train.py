@@ -139,6 +139,8 @@ if __name__ == "__main__":
         use_weighted_train_sampler=config.use_weighted_train_sampler,
         sampling_rate=config.sampling_rate,
         train_override_csvs=config.train_override_csvs,
+        spectrogram_on_device=config.spectrogram_on_device,
+        batch_audio_transform=config.batch_audio_transform,
     )
     datamodule.setup_for_train()
     datamodule.setup_for_inference()
@@ -1,6 +1,8 @@
 import math
 import os
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from math import ceil
 from pathlib import Path, PurePath
 from tempfile import NamedTemporaryFile
@@ -16,6 +18,7 @@ import torch_audiomentations
 import torchaudio
 from mpl_toolkits.axes_grid1.axes_divider import make_axes_locatable
 from pydub.utils import get_player_name
+from threadpoolctl import threadpool_limits
 from torch.nn.utils.rnn import pad_sequence
 
 from src.utils.utils_functions import print_tensor
@@ -43,38 +46,37 @@ def stereo_to_mono(audio: torch.Tensor | np.ndarray):
         return librosa.to_mono(audio)
 
 
-def iron_audios(audios: list[np.ndarray], target_width: int):
-    """Add first audio to last audio so that last audio has equal length as all audios. Assumption:
-    all audios in list have the same size except the last one. If there's only one audio it will
-    repeat itself.
+def chunk_and_iron_audio(
+    audio: torch.Tensor | np.ndarray, target_width: int
+) -> np.ndarray:
+    """Splits the audio into chunks of target_width and irons the last chunk: the first chunk is
+    added to the last chunk so that the last chunk has the same length as all chunks. If there's
+    only one chunk it will repeat itself.
 
         target_width = 100
-        audios: |100|100|55|
+        audio: |100|100|55|
         returns |100|100|100|
 
         target_width = 100
-        audios: |55|
+        audio: |55|
         returns |100|
 
-    Args:
-        audios: _description_
+    The chunks are written directly into one preallocated [Chunks, target_width] float32 array.
     """
-    last_chunk = audios[-1]
-    last_chunk_length = len(last_chunk)
-    diff = target_width - last_chunk_length
-
-    # Find how many times should first chunk be repeated (usually >1 for first chunk == first chunk)
-    first_chunk: torch.Tensor = audios[0]
-    first_chunk_width = first_chunk.shape[-1]
-    num_first_chunk_repeats = max(1, ceil(diff / first_chunk_width))
-    repeated_first_chunk = np.concatenate(
-        [first_chunk] * num_first_chunk_repeats, axis=-1
-    )
+    audio = np.asarray(audio, dtype=np.float32)
+    audio_length = len(audio)
+    num_chunks = max(1, ceil(audio_length / target_width))
+
+    chunks = np.empty(num_chunks * target_width, dtype=np.float32)
+    chunks[:audio_length] = audio
 
-    # Remove remove excess width caused by repeating
-    repeated_first_chunk = repeated_first_chunk[..., :diff]
-    audios[-1] = np.concatenate((audios[-1], repeated_first_chunk), axis=-1)
-    return audios
+    diff = len(chunks) - audio_length
+    if diff > 0:
+        # Fill the rest of the last chunk by repeating the first chunk
+        first_chunk = audio[:target_width]
+        num_first_chunk_repeats = ceil(diff / len(first_chunk))
+        chunks[audio_length:] = np.tile(first_chunk, num_first_chunk_repeats)[:diff]
+    return chunks.reshape(num_chunks, target_width)
 
 
 def time_mask_audio(audio: np.ndarray, percentage: float, fill_value: float = 0):
@@ -95,33 +97,93 @@ def time_mask_audio(audio: np.ndarray, percentage: float, fill_value: float = 0)
     return audio
 
 
-def time_stretch(audio: np.ndarray, min_stretch, max_stretch, trim=True):
-    """Audio stretch with random offset + trimming which ensures that the stretched waveform will
-    be the same length as the original.
-
-    A------B-------C        original
-    A---------B---------C   streched
-    ---------B------        trim
-
-    Args:
-        audio: _description_
-        min_stretch: minimal stretch factor
-        max_stretch: maximum stretch factor
-        trim: trim the audio to original legnth
+@lru_cache(maxsize=16)
+def get_mel_basis(sampling_rate: int, n_fft: int, n_mels: int) -> np.ndarray:
+    """Mel filter bank (same as librosa.feature.melspectrogram uses) which is created only once
+    for every set of parameters and shared by all transforms. The array is read-only."""
+    mel_basis = librosa.filters.mel(
+        sr=sampling_rate, n_fft=n_fft, n_mels=n_mels, dtype=np.float32
+    )
+    mel_basis.setflags(write=False)
+    return mel_basis
+
+
+@lru_cache(maxsize=16)
+def get_hann_window(n_fft: int) -> np.ndarray:
+    """Periodic hann window (same as librosa.stft uses) which is created only once for every
+    n_fft and shared by all transforms. The array is read-only."""
+    window = librosa.filters.get_window("hann", n_fft).astype(np.float32)
+    window.setflags(write=False)
+    return window
+
+
+@lru_cache(maxsize=4)
+def _get_time_stretch(
+    n_fft: int, hop_length: int, device: torch.device
+) -> tuple[torch.Tensor, torchaudio.transforms.TimeStretch]:
+    """Window and TimeStretch (phase vocoder with precomputed phase advance of every frequency
+    bin) are created only once for every set of parameters and device."""
+    window = torch.hann_window(n_fft, device=device)
+    time_stretch = torchaudio.transforms.TimeStretch(
+        hop_length=hop_length, n_freq=n_fft // 2 + 1
+    ).to(device)
+    return window, time_stretch
+
+
+def stretch_audio(
+    audio: torch.Tensor | np.ndarray,
+    rate: float,
+    n_fft: int = 2048,
+    hop_length: int = 512,
+) -> torch.Tensor | np.ndarray:
+    """Phase vocoder time stretch in torch (same algorithm and defaults as
+    librosa.effects.time_stretch) which returns the same type (torch or numpy).
+
+    rate > 1 speeds the audio up, rate < 1 slows it down. The last dimension is time.
     """
+    is_numpy = isinstance(audio, np.ndarray)
+    audio_torch = torch.from_numpy(audio) if is_numpy else audio
+    window, time_stretch = _get_time_stretch(n_fft, hop_length, audio_torch.device)
+
+    shape = audio_torch.shape
+    audio_torch = audio_torch.reshape(-1, shape[-1]).float()
+    stft = torch.stft(
+        audio_torch,
+        n_fft=n_fft,
+        hop_length=hop_length,
+        window=window,
+        pad_mode="constant",
+        return_complex=True,
+    )
+    stft_stretched = time_stretch(stft, rate)
+    length = int(round(shape[-1] / rate))
+    stretched = torch.istft(
+        stft_stretched,
+        n_fft=n_fft,
+        hop_length=hop_length,
+        window=window,
+        length=length,
+    )
+    stretched = stretched.reshape(*shape[:-1], length)
+    return stretched.numpy() if is_numpy else stretched
+
 
-    stretch_rate = np.random.uniform(min_stretch, max_stretch)
-    size_before = len(audio)
-    audio = librosa.effects.time_stretch(y=audio, rate=stretch_rate)
+@lru_cache(maxsize=16)
+def _get_resampler(orig_sr: int, target_sr: int) -> torchaudio.transforms.Resample:
+    """Resampling kernel is created only once for every (orig_sr, target_sr) pair."""
+    return torchaudio.transforms.Resample(orig_freq=orig_sr, new_freq=target_sr)
 
-    if not trim:
-        return audio
 
-    diff = max(len(audio) - size_before, 0)
-    offset = np.random.randint(0, diff + 1)
-    audio_offset = audio[offset:]
-    audio_trimmed = librosa.util.fix_length(audio_offset, size=size_before)
-    return audio_trimmed
+def resample_audio(
+    audio: torch.Tensor | np.ndarray, orig_sr: int, target_sr: int
+) -> torch.Tensor | np.ndarray:
+    """Resamples the audio with the cached resampler and returns the same type (torch or
+    numpy)."""
+    resampler = _get_resampler(int(orig_sr), int(target_sr))
+    if isinstance(audio, np.ndarray):
+        audio_torch = torch.from_numpy(audio).to(resampler.kernel.dtype)
+        return resampler(audio_torch).numpy()
+    return resampler(audio.to(resampler.kernel.dtype))
 
 
 def load_audio_from_file(
@@ -136,30 +198,60 @@ def load_audio_from_file(
     """
 
     if method == "librosa":
-        waveform, original_sr = librosa.load(audio_path, sr=target_sr, mono=True)
+        waveform, original_sr = librosa.load(audio_path, sr=None, mono=True)
+        if target_sr is not None and original_sr != target_sr:
+            waveform = resample_audio(waveform, original_sr, target_sr)
         if normalize:
             waveform = librosa.util.normalize(waveform)
 
     elif method == "torch":
         # default normalize for torch is True
         waveform, original_sr = torchaudio.load(audio_path, normalize=normalize)
-        torch.mean(waveform, dim=0, keepdim=False)
-        if target_sr is not None:
-            torchaudio.functional.resample(
-                waveform, orig_freq=original_sr, new_freq=target_sr
-            )
+        waveform = torch.mean(waveform, dim=0, keepdim=False)
+        if target_sr is not None and original_sr != target_sr:
+            waveform = resample_audio(waveform, original_sr, target_sr)
 
     return_sr = target_sr if target_sr is not None else original_sr
     return waveform, return_sr
 
 
+def load_audio_batch(
+    audio_paths: list[Path | str],
+    target_sr: int | None,
+    method: str = "librosa",
+    normalize=True,
+) -> list[tuple[torch.Tensor | np.ndarray, int]]:
+    """Loads multiple audio files concurrently and returns them in the same order.
+
+    Decoding and resampling mostly release the GIL so files are loaded with a thread pool. Pool
+    is sized so that all DataLoader workers together use at most all CPUs and BLAS/OpenMP threads
+    are limited to 1 to avoid oversubscribing the CPU.
+    """
+    if len(audio_paths) <= 1:
+        return [
+            load_audio_from_file(path, target_sr, method, normalize)
+            for path in audio_paths
+        ]
+
+    worker_info = torch.utils.data.get_worker_info()
+    num_workers = worker_info.num_workers if worker_info is not None else 1
+    num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+    num_threads = min(num_threads, len(audio_paths))
+
+    def load(audio_path: Path | str):
+        return load_audio_from_file(audio_path, target_sr, method, normalize)
+
+    with threadpool_limits(limits=1), ThreadPoolExecutor(num_threads) as executor:
+        return list(executor.map(load, audio_paths))
+
+
 def spectrogram_to_list(
     spectrograms: np.ndarray | torch.Tensor | list[np.ndarray | torch.Tensor],
     n_mels: int,
 ) -> np.ndarray:
     """Send one or multiple spectrograms [height, weight] and return as [batch, height, weight]"""
     if isinstance(spectrograms, np.ndarray):
-        spectrograms = torch.tensor(spectrograms)
+        spectrograms = torch.from_numpy(spectrograms)
 
     if isinstance(spectrograms, torch.Tensor) and len(spectrograms.shape) == 2:
         spectrograms = spectrograms.unsqueeze(0)
@@ -168,13 +260,13 @@ def spectrogram_to_list(
         spectrograms = [s for s in spectrograms]
 
     if isinstance(spectrograms, np.ndarray) and len(spectrograms.shape) == 3:
-        spectrograms = [torch.tensor(s) for s in spectrograms]
+        spectrograms = [torch.from_numpy(s) for s in spectrograms]
 
     if isinstance(spectrograms, np.ndarray):
-        spectrograms = torch.tensor(spectrograms)
+        spectrograms = torch.from_numpy(spectrograms)
 
     if isinstance(spectrograms, list) and isinstance(spectrograms[0], np.ndarray):
-        spectrograms = [torch.tensor(s) for s in spectrograms]
+        spectrograms = [torch.from_numpy(s) for s in spectrograms]
 
     spectrograms = [s.T for s in spectrograms]  # [w, h]
     spectrograms = pad_sequence(spectrograms, batch_first=True)  # [w, h]
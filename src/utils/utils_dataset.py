@@ -9,14 +9,16 @@ from src.utils.utils_exceptions import InvalidDataException
 
 
 def create_and_repeat_channel(images: torch.Tensor, num_repeat: int):
-    # Create new dimension then repeat along it.
+    # Create new dimension then repeat along it. Expand returns a view so the channels share the
+    # memory instead of copying the image num_repeat times. Call .contiguous() before writing to
+    # the result.
     if len(images.shape) == 3:
-        return images.unsqueeze(dim=1).repeat(1, num_repeat, 1, 1)
-    return images.unsqueeze(dim=0).repeat(num_repeat, 1, 1)
+        return images.unsqueeze(dim=1).expand(-1, num_repeat, -1, -1)
+    return images.unsqueeze(dim=0).expand(num_repeat, -1, -1)
 
 
 def add_rgb_channel(images: torch.Tensor):
-    return create_and_repeat_channel(images, 3)
+    return create_and_repeat_channel(images, config_defaults.NUM_RGB_CHANNELS)
 
 
 def remove_rgb_channel(images: torch.Tensor):
@@ -28,7 +30,7 @@ def concat_images(
     image_batch: list[torch.Tensor] | torch.Tensor | np.ndarray,
 ):
     if isinstance(image_batch, torch.Tensor) or isinstance(image_batch, np.ndarray):
-        image_batch = [torch.tensor(t) for t in image_batch]
+        image_batch = [torch.as_tensor(t) for t in image_batch]
     return torch.cat(image_batch, dim=-1)
 
 